@@ -0,0 +1,49 @@
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# Kept out of harigamiweb.py so pool workers can unpickle these functions by module name;
+# Streamlit swaps __main__ on every rerun, which breaks references to the script itself
+
+worker_template_parts = None
+
+# Control characters XML 1.0 cannot represent; tab, LF and CR are handled below
+INVALID_XML_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def to_run_xml(text):
+    # Reject what lxml would have refused through python-docx, so the row is reported as failed
+    if INVALID_XML_CHARS_RE.search(text):
+        raise ValueError("text contains characters that are not valid in XML")
+    # Mirror python-docx's run.text setter: tabs and line breaks become their own run elements
+    text = escape(text)
+    text = text.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+    for br in ('\r', '\n'):
+        text = text.replace(br, '</w:t><w:br/><w:t xml:space="preserve">')
+    return text
+
+def init_render_worker(template_parts):
+    global worker_template_parts
+    worker_template_parts = template_parts
+
+def render_document(replacements):
+    values = {key: to_run_xml(value).encode('utf-8') for key, value in replacements.items()}
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for name, data, compress_type, segments in worker_template_parts:
+            if segments:
+                pieces = segments.copy()
+                pieces[1::2] = [values[key] for key in segments[1::2]]
+                data = b''.join(pieces)
+            zf.writestr(name, data, compress_type=compress_type)
+    return buffer.getvalue()
+
+def render_batch(batch):
+    results = []
+    for output_file_name, replacements in batch:
+        try:
+            results.append((output_file_name, render_document(replacements)))
+        except Exception:
+            results.append((output_file_name, None))
+    return results
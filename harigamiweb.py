@@ -2,17 +2,30 @@ import streamlit as st
 import os
 import pandas as pd
 from docx import Document
-from docx.shared import Pt
-from datetime import datetime
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+import importlib.util
 import warnings
 import io
 import zipfile
 import re
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from harigami_render import init_render_worker, render_batch
 
 warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
 
 DEFAULT_TEMPLATE_PATH = "harigami.docx"
-OUTPUT_DIR = "output_docs"
+REQUIRED_COLUMNS = ["物件名", "予定開始", "予定終了"]
+WEEKDAY_JP = ('月', '火', '水', '木', '金', '土', '日')
+# calamine (Rust) is much faster; openpyxl remains as a fallback for installs without it
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+RENDER_BATCH_SIZE = 8
+# Media in these formats is already compressed; deflating it again inside each .docx only costs CPU
+PRECOMPRESSED_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.gif')
+# Raised by the process pool itself (dead workers, arguments or results that fail to pickle or
+# unpickle); render_batch catches render errors per document, so these are worth a thread retry
+POOL_ERRORS = (BrokenProcessPool, pickle.PicklingError, AttributeError, TypeError)
 
 PLACEHOLDERS = {
     "［10月　19日（水）］": "DATE",
@@ -20,86 +33,197 @@ PLACEHOLDERS = {
     "［11:00］": "END_TIME",
     "［物件名］": "NAME",
 }
+CENTERED_KEYS = frozenset({"DATE", "START_TIME", "END_TIME"})
+
+PLACEHOLDER_RE = re.compile('|'.join(re.escape(ph) for ph in PLACEHOLDERS))
+# Every placeholder opens with a fullwidth bracket; paragraphs without one can be skipped outright
+PLACEHOLDER_OPEN = "［"
+# A lone unsafe character, or any run of unsafe characters and underscores, collapses to one "_"
+UNSAFE_FILENAME_RE = re.compile(r'(?:[^\w\.\-]|_){2,}|[^\w\.\-]')
+
+# Single-run stand-ins written into the template once, then swapped for row values in the raw XML
+PLACEHOLDER_MARKERS = {key: f"{{{{harigami:{key}}}}}" for key in PLACEHOLDERS.values()}
+MARKER_KEYS = {marker.encode('utf-8'): key for key, marker in PLACEHOLDER_MARKERS.items()}
+MARKER_BYTES_RE = re.compile(b'(' + b'|'.join(re.escape(marker) for marker in MARKER_KEYS) + b')')
 
 def replace_placeholders_preserve_format(paragraph, replacements):
-    full_text = paragraph.text
-    should_center = False
-
-    for ph, key in PLACEHOLDERS.items():
-        if ph in full_text:
-            if key in ["DATE", "START_TIME", "END_TIME"]:
-                should_center = True
-
-            for run in paragraph.runs:
-                if ph in run.text:
-                    original_font_size = run.font.size
-                    original_bold = run.font.bold
-                    original_italic = run.font.italic
-                    original_underline = run.font.underline
-                    original_color = run.font.color
-                    
-                    run.text = run.text.replace(ph, replacements[key])
-                    
-                    if original_font_size:
-                        run.font.size = original_font_size
-                    if original_bold is not None:
-                        run.font.bold = original_bold
-                    if original_italic is not None:
-                        run.font.italic = original_italic
-                    if original_underline is not None:
-                        run.font.underline = original_underline
-                    if original_color:
-                        run.font.color.rgb = original_color.rgb
-                    break
-            
-            current_text = paragraph.text
-            if ph in current_text:
-                replace_text_across_runs(paragraph, ph, replacements[key])
-    
+    runs = paragraph.runs
+    full_text = ''.join(run.text for run in runs)
+    if PLACEHOLDER_OPEN not in full_text:
+        return
+
+    found = PLACEHOLDER_RE.findall(full_text)
+    if not found:
+        return
+
+    should_center = any(PLACEHOLDERS[ph] in CENTERED_KEYS for ph in found)
+
+    def substitute(match):
+        return replacements[PLACEHOLDERS[match.group(0)]]
+
+    replaced_in_runs = 0
+    for run in runs:
+        text, count = PLACEHOLDER_RE.subn(substitute, run.text)
+        if count:
+            original_font_size = run.font.size
+            original_bold = run.font.bold
+            original_italic = run.font.italic
+            original_underline = run.font.underline
+            original_color = run.font.color
+
+            run.text = text
+
+            if original_font_size:
+                run.font.size = original_font_size
+            if original_bold is not None:
+                run.font.bold = original_bold
+            if original_italic is not None:
+                run.font.italic = original_italic
+            if original_underline is not None:
+                run.font.underline = original_underline
+            if original_color:
+                run.font.color.rgb = original_color.rgb
+            replaced_in_runs += count
+
+    # Whatever the runs did not contain whole is split across runs
+    if replaced_in_runs < len(found):
+        if replaced_in_runs:
+            full_text = ''.join(run.text for run in runs)
+        for ph, key in PLACEHOLDERS.items():
+            if ph in full_text:
+                full_text = replace_text_across_runs(runs, full_text, ph, replacements[key])
+
     if should_center:
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
         paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-def replace_text_across_runs(paragraph, search_text, replace_text):
-    full_text = ''.join(run.text for run in paragraph.runs)
-    
+def replace_text_across_runs(runs, full_text, search_text, replace_text):
     if search_text in full_text:
-        new_text = full_text.replace(search_text, replace_text)
-        if paragraph.runs:
-            first_run = paragraph.runs[0]
-            for run in paragraph.runs[1:]:
+        full_text = full_text.replace(search_text, replace_text)
+        if runs:
+            first_run = runs[0]
+            for run in runs[1:]:
                 run.text = ""
-            first_run.text = new_text
-
-def replace_placeholders_in_tables(doc, replacements):
+            first_run.text = full_text
+    return full_text
+
+def iter_table_paragraphs(table):
+    for row in table.rows:
+        for cell in row.cells:
+            yield from cell.paragraphs
+            for nested_table in cell.tables:
+                yield from iter_table_paragraphs(nested_table)
+
+def iter_all_paragraphs(doc):
+    yield from doc.paragraphs
     for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    replace_placeholders_preserve_format(paragraph, replacements)
+        yield from iter_table_paragraphs(table)
 
-def replace_placeholders_comprehensive(doc, replacements):
-    for para in doc.paragraphs:
-        if para.text.strip():
-            replace_placeholders_preserve_format(para, replacements)
-    
-    replace_placeholders_in_tables(doc, replacements)
-    
     for section in doc.sections:
-        if section.header:
-            for para in section.header.paragraphs:
-                replace_placeholders_preserve_format(para, replacements)
-        
-        if section.footer:
-            for para in section.footer.paragraphs:
-                replace_placeholders_preserve_format(para, replacements)
+        yield from section.header.paragraphs
+        yield from section.footer.paragraphs
+
+def replace_placeholders_comprehensive(doc, replacements):
+    for para in iter_all_paragraphs(doc):
+        replace_placeholders_preserve_format(para, replacements)
+
+@st.cache_data(show_spinner=False)
+def load_schedule(excel_bytes):
+    return pd.read_excel(io.BytesIO(excel_bytes), sheet_name="作業指示書 の一覧", engine=EXCEL_ENGINE,
+                         usecols=REQUIRED_COLUMNS)
+
+@st.cache_data(show_spinner=False)
+def prepare_template_parts(template_bytes):
+    doc = Document(io.BytesIO(template_bytes))
+    replace_placeholders_comprehensive(doc, PLACEHOLDER_MARKERS)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+
+    parts = []
+    with zipfile.ZipFile(buffer) as zf:
+        for name in zf.namelist():
+            data = zf.read(name)
+            if name.lower().endswith(PRECOMPRESSED_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            # Split once into [literal, key, literal, key, ..., literal] so a row is a single join
+            segments = MARKER_BYTES_RE.split(data)
+            if len(segments) > 1:
+                segments[1::2] = [MARKER_KEYS[marker] for marker in segments[1::2]]
+            else:
+                segments = None
+            parts.append((name, data, compress_type, segments))
+    return parts
+
+def create_render_executor(template_parts, max_workers):
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers,
+                                   initializer=init_render_worker,
+                                   initargs=(template_parts,))
+    except (OSError, NotImplementedError, ImportError):
+        # No working multiprocessing here (e.g. no semaphore support); zlib releases
+        # the GIL while compressing, so threads still overlap part of the work
+        init_render_worker(template_parts)
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+def collect_batches(executor, batches, unfinished=None):
+    # With an unfinished list, batches lost to POOL_ERRORS are handed back for a retry;
+    # without one (the retry itself), anything lost is reported as failed
+    futures = {}
+    for batch in batches:
+        try:
+            futures[executor.submit(render_batch, batch)] = batch
+        except POOL_ERRORS:
+            if unfinished is None:
+                raise
+            unfinished.append(batch)
+
+    for future in as_completed(futures):
+        batch = futures[future]
+        try:
+            results = future.result()
+        except POOL_ERRORS:
+            if unfinished is not None:
+                unfinished.append(batch)
+                continue
+            results = [(output_file_name, None) for output_file_name, _ in batch]
+        except Exception:
+            # Report the batch's documents as failed rather than aborting the run
+            results = [(output_file_name, None) for output_file_name, _ in batch]
+        yield results
+
+def render_batches(template_parts, batches):
+    if len(batches) <= 1:
+        # Starting workers and shipping them the template costs more than one batch saves
+        init_render_worker(template_parts)
+        for batch in batches:
+            yield render_batch(batch)
+        return
+
+    # More workers than batches would only pay start-up and template transfer for nothing
+    max_workers = min(os.cpu_count() or 1, len(batches))
+    unfinished = []
+    with create_render_executor(template_parts, max_workers) as executor:
+        yield from collect_batches(executor, batches, unfinished)
+
+    if unfinished:
+        # The process pool failed at run time (a killed worker, a platform where workers
+        # cannot start, or data that would not cross the process boundary); finish in-process
+        init_render_worker(template_parts)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unfinished))) as executor:
+            yield from collect_batches(executor, unfinished)
 
 def process_excel_and_generate_docs(excel_file_buffer, template_source, is_uploaded):
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    generated_file_paths = []
+    generated_docs = []
 
     try:
-        df = pd.read_excel(excel_file_buffer, sheet_name="作業指示書 の一覧", engine='openpyxl')
+        if is_uploaded:
+            template_bytes = template_source.getvalue()
+        else:
+            with open(template_source, 'rb') as f:
+                template_bytes = f.read()
+
+        df = load_schedule(excel_file_buffer.getvalue())
         total_rows = len(df)
         st.info(f"📊 {total_rows}件のデータを読み込みました。文書生成を開始します...")
         
@@ -107,66 +231,75 @@ def process_excel_and_generate_docs(excel_file_buffer, template_source, is_uploa
         progress_bar = st.progress(0)
         processed_count = 0
 
-        for index, row in df.iterrows():
-            progress_percent = (index + 1) / total_rows
-            progress_bar.progress(progress_percent)
-            progress_text.text(f"処理中: {index + 1} / {total_rows} 件完了")
-
-            try:
-                if pd.isna(row["物件名"]) or pd.isna(row["予定開始"]) or pd.isna(row["予定終了"]):
-                    continue
-                
-                name = str(row["物件名"]).strip()
-                start_dt = pd.to_datetime(row["予定開始"], errors='coerce')
-                end_dt = pd.to_datetime(row["予定終了"], errors='coerce')
-                if pd.isna(start_dt) or pd.isna(end_dt):
-                    continue
-
-                weekdays = {'Mon': '月', 'Tue': '火', 'Wed': '水', 'Thu': '木', 
-                            'Fri': '金', 'Sat': '土', 'Sun': '日'}
-                weekday = weekdays[start_dt.strftime('%a')]
-                date_str = f"{start_dt.month}月{start_dt.day}日（{weekday}）"
-                start_str = start_dt.strftime("%H:%M")
-                end_str = end_dt.strftime("%H:%M")
-
-            except Exception:
-                continue
-
-            replacements = {
+        df = df.dropna(subset=REQUIRED_COLUMNS)
+        start_dt = pd.to_datetime(df["予定開始"], errors='coerce', format='mixed')
+        end_dt = pd.to_datetime(df["予定終了"], errors='coerce', format='mixed')
+        valid = start_dt.notna() & end_dt.notna()
+        df, start_dt, end_dt = df[valid], start_dt[valid], end_dt[valid]
+
+        rows = pd.DataFrame({
+            "name": df["物件名"].astype(str).str.strip(),
+            "date": (start_dt.dt.month.astype(str) + "月" + start_dt.dt.day.astype(str) + "日（"
+                     + start_dt.dt.dayofweek.map(dict(enumerate(WEEKDAY_JP))) + "）"),
+            "start": start_dt.dt.strftime("%H:%M"),
+            "end": end_dt.dt.strftime("%H:%M"),
+        })
+        safe_names = rows["name"].str.replace(UNSAFE_FILENAME_RE, "_", regex=True).str.strip("_")
+        rows["safe_name"] = safe_names.replace("", "untitled_document")
+
+        # Compare the stripped name and full timestamps; the display strings drop the year and
+        # sanitizing merges distinct names, so neither is a safe duplicate key
+        duplicated = pd.DataFrame({"name": rows["name"], "start": start_dt, "end": end_dt}).duplicated()
+        duplicate_count = int(duplicated.sum())
+        rows = rows[~duplicated]
+
+        jobs = {}
+        for name, date_str, start_str, end_str, safe_name in rows.itertuples(index=False, name=None):
+            # Distinct rows that sanitize to the same name get numbered instead of overwriting each other
+            output_file_name = f"{safe_name}.docx"
+            suffix = 2
+            while output_file_name in jobs:
+                output_file_name = f"{safe_name}_{suffix}.docx"
+                suffix += 1
+
+            jobs[output_file_name] = {
                 "DATE": date_str,
                 "START_TIME": start_str,
                 "END_TIME": end_str,
                 "NAME": name
             }
 
-            try:
-                if is_uploaded:
-                    template_source.seek(0)
-                    doc = Document(template_source)
+        if duplicate_count:
+            st.info(f"🔁 重複している{duplicate_count}件の行をスキップしました。")
+
+        total_jobs = len(jobs)
+        progress_step = max(1, total_jobs // 100)
+        failed_names = []
+        job_items = list(jobs.items())
+        batches = [job_items[i:i + RENDER_BATCH_SIZE] for i in range(0, total_jobs, RENDER_BATCH_SIZE)]
+        done = 0
+        next_progress = progress_step
+        for results in render_batches(prepare_template_parts(template_bytes), batches):
+            for output_file_name, data in results:
+                if data is None:
+                    failed_names.append(output_file_name)
                 else:
-                    doc = Document(template_source)
-
-                replace_placeholders_comprehensive(doc, replacements)
-
-                safe_name = re.sub(r'[^\w\.\-]', '_', name)
-                safe_name = re.sub(r'_{2,}', '_', safe_name)
-                safe_name = safe_name.strip('_') or "untitled_document"
-
-                output_file_name = f"{safe_name}.docx"
-                output_path = os.path.join(OUTPUT_DIR, output_file_name)
-                doc.save(output_path)
-
-                if os.path.exists(output_path):
-                    generated_file_paths.append(output_path)
+                    generated_docs.append((output_file_name, data))
                     processed_count += 1
 
-            except Exception:
-                continue
+            done += len(results)
+            if done >= next_progress or done == total_jobs:
+                progress_bar.progress(done / total_jobs)
+                progress_text.text(f"処理中: {done} / {total_jobs} 件完了")
+                next_progress = done + progress_step
+
+        if failed_names:
+            st.warning(f"⚠️ {len(failed_names)}件の文書を生成できませんでした: {', '.join(failed_names)}")
 
         progress_bar.progress(1.0)
         progress_text.text(f"処理完了: {processed_count} / {total_rows} 件完了")
         st.success(f"\n🎉 {processed_count}件の通知文書の生成が完了しました！")
-        return generated_file_paths
+        return generated_docs
 
     except Exception as e:
         st.error(f"❌ エラーが発生しました: {str(e)}")
@@ -220,31 +353,22 @@ if uploaded_file and template_ready:
 
     if st.button("3. Word文書を生成する"):
         with st.spinner("Word文書を生成中...しばらくお待ちください。"):
-            excel_buffer = io.BytesIO(uploaded_file.read())
-            if is_uploaded_template:
-                template_buffer = io.BytesIO(template_info.read())
-                generated_doc_paths = process_excel_and_generate_docs(excel_buffer, template_buffer, True)
-            else:
-                generated_doc_paths = process_excel_and_generate_docs(excel_buffer, template_info, False)
+            generated_docs = process_excel_and_generate_docs(uploaded_file, template_info, is_uploaded_template)
 
-        if generated_doc_paths:
+        if generated_docs:
             st.subheader("🎉 生成された文書をまとめてダウンロード")
             zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                for doc_path in generated_doc_paths:
-                    zf.write(doc_path, os.path.basename(doc_path))
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
+                for file_name, data in generated_docs:
+                    zf.writestr(file_name, data)
             zip_buffer.seek(0)
 
             st.download_button(
                 label="全てのWord文書をZIPでダウンロード",
-                data=zip_buffer.getvalue(),
+                data=zip_buffer,
                 file_name="generated_word_documents.zip",
                 mime="application/zip"
             )
-
-            for doc_path in generated_doc_paths:
-                if os.path.exists(doc_path):
-                    os.remove(doc_path)
         else:
             st.warning("文書の生成に失敗したか、対象データがありません。")
 else: